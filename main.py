@@ -3,21 +3,31 @@
 # Fix: корректная проверка обязательных ENV (TG_WEBHOOK_SECRET -> TG_SECRET mapping)
 
 import os
-import json
+import re
 import time
 import threading
 import logging
 import hashlib
+import copy
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from typing import Any, Dict, Optional, List
 
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, abort, jsonify
-from sqlalchemy import create_engine, text
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import create_engine, text, event
 from sqlalchemy.pool import QueuePool
+from psycopg.types.json import set_json_loads
 import telebot
-from telebot import types
-from openai import OpenAI
+from telebot import types, apihelper
+from openai import OpenAI, RateLimitError
 
 # ========= Version / Hash =========
 def _code_hash() -> str:
@@ -27,7 +37,8 @@ def _code_hash() -> str:
     except Exception:
         return "unknown"
 
-BOT_VERSION = f"2025-10-18-{_code_hash()}"
+CODE_HASH = _code_hash()  # файл не меняется после импорта — считаем один раз
+BOT_VERSION = f"2025-10-18-{CODE_HASH}"
 
 # ========= ENV =========
 def _env(name: str, default: str = "") -> str:
@@ -50,6 +61,23 @@ REMINDERS_ENABLED   = _env("REMINDERS_ENABLED", "true").lower() == "true"
 IDLE_MINUTES_REMIND = int(_env("IDLE_MINUTES_REMIND", "60"))
 IDLE_MINUTES_RESET  = int(_env("IDLE_MINUTES_RESET", "240"))
 
+TG_MAX_CONNECTIONS = int(_env("TG_MAX_CONNECTIONS", "100"))
+GPT_CACHE_SIZE     = int(_env("GPT_CACHE_SIZE", "2048"))
+GPT_CACHE_TTL      = int(_env("GPT_CACHE_TTL", "3600"))  # сек
+GPT_MAX_TOKENS     = int(_env("GPT_MAX_TOKENS", "600"))
+GPT_CONTEXT_CHARS  = int(_env("GPT_CONTEXT_CHARS", "6000"))  # бюджет истории в промпте
+DB_SLOW_MS         = int(_env("DB_SLOW_MS", "100"))
+DB_AUTO_INIT       = _env("DB_AUTO_INIT", "true").lower() == "true"  # false — схему накатывают отдельно при деплое
+UPDATE_WORKERS     = int(_env("UPDATE_WORKERS", "16"))  # 0 — обрабатывать апдейт прямо в запросе вебхука
+OPENAI_CONCURRENCY = int(_env("OPENAI_CONCURRENCY", "8"))  # одновременных запросов в OpenAI на процесс
+UPDATE_QUEUE_MAX   = int(_env("UPDATE_QUEUE_MAX", "1024"))  # апдейтов в работе; сверх — 503, Telegram повторит позже
+UPDATE_QUEUE_PER_USER = int(_env("UPDATE_QUEUE_PER_USER", "20"))  # очередь одного чата; сверх — апдейт отбрасываем
+STATE_UNLOGGED     = _env("STATE_UNLOGGED", "false").lower() == "true"  # opt-in: после краша таблица пустая, см. README
+TG_SEND_RATE       = float(_env("TG_SEND_RATE", "29"))  # сообщений/сек на весь бот (лимит Telegram — 30)
+TG_CHAT_RATE       = float(_env("TG_CHAT_RATE", "1"))   # сообщений/сек в один чат
+TG_CHAT_BURST      = float(_env("TG_CHAT_BURST", "3"))
+DB_PREPARE_THRESHOLD = _env("DB_PREPARE_THRESHOLD", "1")  # пусто — без prepared statements (старый pgbouncer в transaction-режиме)
+
 HIST_LIMIT = 18
 
 # ========= Guards (исправлено) =========
@@ -68,7 +96,7 @@ if _missing:
 # ========= Logging =========
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 log = logging.getLogger("kai-mentor")
-log.info(f"Starting bot version: {BOT_VERSION}")
+log.info("Starting bot version: %s", BOT_VERSION)
 
 # ========= Intents/Steps =========
 INTENT_GREET = "greet"
@@ -89,6 +117,19 @@ STEP_TOTE_TEST  = "tote_test"
 STEP_TOTE_EXIT  = "tote_exit"
 
 MER_ORDER = [STEP_MER_CTX, STEP_MER_EMO, STEP_MER_THO, STEP_MER_BEH]
+MER_NEXT = dict(zip(MER_ORDER, MER_ORDER[1:] + [STEP_GOAL]))
+
+# Вопросы структурного разбора: по шагу, на который переходим
+STEP_PROMPTS = {
+    STEP_MER_CTX:   "Зафиксируем картинку. Где и когда это было? Коротко.",
+    STEP_MER_EMO:   "Что почувствовал в моменте (2–3 слова)?",
+    STEP_MER_THO:   "Какие мысли мелькали (2–3 коротких фразы)?",
+    STEP_MER_BEH:   "Что сделал фактически? Действия.",
+    STEP_GOAL:      "Сформулируй позитивную цель: что будешь делать вместо прежнего поведения?",
+    STEP_TOTE_OPS:  "Для ближайших 3 сделок назови 2–3 конкретных шага (коротко, списком).",
+    STEP_TOTE_TEST: "Как поймёшь, что получилось? Один простой критерий.",
+    STEP_TOTE_EXIT: "Если проверка покажет «не получилось» — что сделаешь?",
+}
 
 RISK_PATTERNS = {
     "remove_stop": ["убираю стоп", "снял стоп", "без стопа"],
@@ -103,99 +144,262 @@ EMO_PATTERNS = {
     "fear_of_loss": ["страх потерь", "боюсь стопа", "не хочу быть обманутым"],
 }
 
+# ё/Ё → е одним проходом по таблице (str.translate), до casefold
+_YO_TABLE = str.maketrans("ёЁ", "ее")
+
+# Все ключевые фразы — в одном скомпилированном выражении: один проход по тексту
+# вместо any(k in tl ...) на каждый паттерн. Lookahead ловит и перекрывающиеся фразы.
+# Фразы и текст сводим к одному виду (ё → е): «уйдет без меня» = «уйдёт без меня».
+_PATTERN_ORDER = list({**RISK_PATTERNS, **EMO_PATTERNS})
+_PATTERN_TAGS = {k.translate(_YO_TABLE): name for name, keys in {**RISK_PATTERNS, **EMO_PATTERNS}.items() for k in keys}
+_PATTERN_RE = re.compile("(?=(" + "|".join(re.escape(k) for k in sorted(_PATTERN_TAGS, key=len, reverse=True)) + "))")
+_RISK_NAMES = frozenset(RISK_PATTERNS) | {"fear_of_loss", "self_doubt"}
+
 def detect_patterns(text_in: str) -> List[str]:
-    tl = (text_in or "").lower()
-    hits = []
-    for name, keys in {**RISK_PATTERNS, **EMO_PATTERNS}.items():
-        if any(k in tl for k in keys):
-            hits.append(name)
-    return hits
+    tl = (text_in or "").translate(_YO_TABLE).casefold()
+    found = {_PATTERN_TAGS[m.group(1)] for m in _PATTERN_RE.finditer(tl)}
+    return [name for name in _PATTERN_ORDER if name in found]
 
 def risky(text_in: str) -> bool:
-    pats = set(detect_patterns(text_in))
-    return bool(pats & set(RISK_PATTERNS.keys())) or ("fear_of_loss" in pats) or ("self_doubt" in pats)
+    return not _RISK_NAMES.isdisjoint(detect_patterns(text_in))
 
 # ========= OpenAI =========
 oai_client: Optional[OpenAI] = None
 openai_status = "disabled"
+# Один httpx-клиент на процесс: HTTP/2 мультиплексирует параллельные запросы
+# в одном TLS-соединении, keepalive держит его между апдейтами.
+oai_http = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(20.0, connect=3.0),
+)
+# Без пинга на старте: платный запрос и лишний RTT на каждом холодном старте,
+# ошибки ключа/сети всплывут на первом запросе и уйдут в лог.
 if OPENAI_API_KEY and OFFSCRIPT_ENABLED:
     try:
-        oai_client = OpenAI(api_key=OPENAI_API_KEY)
-        oai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role": "user", "content": "ping"}],
-            max_tokens=4,
-        )
+        oai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=oai_http)
         openai_status = "active"
         log.info("OpenAI ready")
     except Exception as e:
-        log.error(f"OpenAI init error: {e}")
+        log.error("OpenAI init error: %s", e)
         openai_status = f"error: {e}"
         oai_client = None
 
 # ========= DB =========
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import QueuePool
+set_json_loads(orjson.loads)  # jsonb из БД разбираем orjson, а не stdlib json
+
+def _db_url(url: str) -> str:
+    # в requirements psycopg 3; для голого postgres(ql):// SQLAlchemy выбрал бы psycopg2
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
 engine = create_engine(
-    DATABASE_URL,
+    _db_url(DATABASE_URL),
     poolclass=QueuePool,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
+    pool_size=10,
+    max_overflow=20,
+    pool_timeout=10,
     pool_recycle=1800,
+    pool_pre_ping=True,
+    pool_use_lifo=True,                 # тёплые соединения переиспользуются, лишние быстрее отмирают
+    pool_reset_on_return="rollback",
+    connect_args={
+        "options": "-c statement_timeout=5000",
+        # load/save state — одни и те же запросы на каждом апдейте: готовим их на сервере со второго раза
+        "prepare_threshold": int(DB_PREPARE_THRESHOLD) if DB_PREPARE_THRESHOLD else None,
+    },
 )
 
-def db_exec(sql: str, params: Optional[Dict[str, Any]] = None):
-    with engine.begin() as conn:
-        return conn.execute(text(sql), params or {})
+# Медленные запросы (> DB_SLOW_MS) — в лог, чтобы видеть, что тормозит апдейт
+@event.listens_for(engine, "before_cursor_execute")
+def _q_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info["q_t0"] = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _q_end(conn, cursor, statement, parameters, context, executemany):
+    ms = (time.perf_counter() - conn.info.pop("q_t0", time.perf_counter())) * 1000
+    if ms > DB_SLOW_MS:
+        log.warning("Slow query %.0f ms: %s", ms, " ".join(statement.split())[:200])
+
+# Одна транзакция на апдейт: внутри _handle_update все db_exec идут через одно
+# соединение (берётся при первом запросе), COMMIT — в конце, при ошибке — ROLLBACK
+# всего апдейта. Перед запросом к модели соединение отдаём (db_release), но только
+# пока апдейт ничего не записал: фиксировать половину апдейта нельзя.
+_db_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar("db_scope", default=None)
+
+def db_exec(sql, params: Optional[Dict[str, Any]] = None):
+    # sql — строка или заранее собранный text(): горячие запросы держим
+    # готовыми объектами, чтобы не парсить bind-параметры на каждый вызов
+    if isinstance(sql, str):
+        sql = text(sql)
+    scope = _db_scope.get()
+    if scope is None:
+        with engine.begin() as conn:
+            return conn.execute(sql, params or {})
+    if "conn" not in scope:
+        scope["conn"] = engine.connect()
+        scope["tx"] = scope["conn"].begin()
+    return scope["conn"].execute(sql, params or {})
+
+def _db_scope_close(scope: Dict[str, Any], ok: bool):
+    scope.pop("wrote", None)
+    conn = scope.pop("conn", None)
+    if conn is None:
+        return
+    tx = scope.pop("tx")
+    try:
+        if ok:
+            tx.commit()
+        else:
+            tx.rollback()
+    finally:
+        conn.close()
+
+def db_mark_write():
+    scope = _db_scope.get()
+    if scope is not None:
+        scope["wrote"] = True
+
+def db_release():
+    # перед долгим внешним вызовом: не держим «idle in transaction» и соединение
+    # пула, пока ждём OpenAI (слот, троттлинг, таймаут). Только для чтений: если
+    # апдейт уже писал, транзакцию держим до конца — иначе откат при ошибке неполный.
+    scope = _db_scope.get()
+    if scope is not None and not scope.get("wrote"):
+        _db_scope_close(scope, True)
 
 def init_db():
-    db_exec("""
-    CREATE TABLE IF NOT EXISTS user_state(
+    # вся DDL — одним соединением и одной транзакцией, а не begin/commit на каждый запрос
+    scope: Dict[str, Any] = {}
+    token = _db_scope.set(scope)
+    ok = False
+    try:
+        _init_db_ddl()
+        ok = True
+    finally:
+        _db_scope.reset(token)
+        _db_scope_close(scope, ok)
+    log.info("DB initialized")
+
+def _init_db_ddl():
+    db_exec(f"""
+    CREATE {'UNLOGGED ' if STATE_UNLOGGED else ''}TABLE IF NOT EXISTS user_state(
         user_id BIGINT PRIMARY KEY,
         intent TEXT,
         step TEXT,
-        data TEXT,
+        data JSONB,
         updated_at TIMESTAMPTZ DEFAULT now()
     );
     """)
+    # старые инсталляции держали data в TEXT — переводим в JSONB один раз;
+    # смотрим ту же user_state, что и ALTER ниже (по search_path), а не одноимённую из другой схемы
+    col_type = db_exec(
+        "SELECT atttypid::regtype::text FROM pg_attribute "
+        "WHERE attrelid = 'user_state'::regclass AND attname = 'data' AND NOT attisdropped"
+    ).scalar()
+    if col_type == "text":
+        # битый/не-объектный текст не должен валить весь ALTER (колонка осталась бы TEXT,
+        # а save_state и индекс по data->> падали бы): такие строки становятся '{}'
+        db_exec("""
+        CREATE OR REPLACE FUNCTION pg_temp.user_state_data_jsonb(t TEXT) RETURNS JSONB AS $$
+        BEGIN
+            IF jsonb_typeof(t::jsonb) = 'object' THEN
+                RETURN t::jsonb;
+            END IF;
+            RETURN '{}'::jsonb;
+        EXCEPTION WHEN others THEN
+            RETURN '{}'::jsonb;
+        END
+        $$ LANGUAGE plpgsql
+        """)
+        bad = db_exec("""
+            SELECT count(*) FROM user_state
+            WHERE COALESCE(data, '') NOT IN ('', '{}') AND pg_temp.user_state_data_jsonb(data) = '{}'::jsonb
+        """).scalar()
+        if bad:
+            log.warning("user_state.data: %s rows are not a JSON object, reset to {}", bad)
+        db_exec("ALTER TABLE user_state ALTER COLUMN data TYPE JSONB USING pg_temp.user_state_data_jsonb(data)")
+        log.info("user_state.data migrated to JSONB")
+    # напоминалка смотрит только ждущих ответа — частичный индекс вместо скана всей таблицы
+    db_exec("CREATE INDEX IF NOT EXISTS idx_user_state_awaiting ON user_state(user_id) WHERE (data->>'awaiting_reply') = 'true'")
     db_exec("CREATE INDEX IF NOT EXISTS idx_user_state_updated_at ON user_state(updated_at)")
-    db_exec("CREATE INDEX IF NOT EXISTS idx_user_state_intent_step ON user_state(intent, step)")
-    log.info("DB initialized")
+    # по (intent, step) никто не ищет, а индекс обновлялся на каждом save_state
+    db_exec("DROP INDEX IF EXISTS idx_user_state_intent_step")
+    # STATE_UNLOGGED=true — запись без WAL, но после краша таблица очищается
+    # (вместе с готовыми разборами) и не попадает на реплики. По умолчанию LOGGED.
+    want = "u" if STATE_UNLOGGED else "p"
+    cur = db_exec("SELECT relpersistence FROM pg_class WHERE oid = 'user_state'::regclass").scalar()
+    if cur != want:
+        db_exec(f"ALTER TABLE user_state SET {'UNLOGGED' if STATE_UNLOGGED else 'LOGGED'}")
+        log.info("user_state persistence: %s", "UNLOGGED" if STATE_UNLOGGED else "LOGGED")
 
 # ========= State helpers =========
+_SQL_LOAD_STATE = text("SELECT intent, step, data FROM user_state WHERE user_id=:uid")
+# дефолты intent/step — константы, биндим один раз, а не шлём с каждым вызовом
+_SQL_SAVE_STATE = text("""
+    INSERT INTO user_state (user_id, intent, step, data, updated_at)
+    VALUES (:uid, COALESCE(CAST(:intent AS TEXT), :intent0), COALESCE(CAST(:step AS TEXT), :step0), CAST(:data AS JSONB), now())
+    ON CONFLICT (user_id) DO UPDATE
+    SET intent = COALESCE(CAST(:intent AS TEXT), user_state.intent),
+        step   = COALESCE(CAST(:step AS TEXT), user_state.step),
+        data   = COALESCE(user_state.data, '{}'::jsonb) || EXCLUDED.data,
+        updated_at = now()
+    RETURNING intent, step, data
+""").bindparams(intent0=INTENT_GREET, step0=STEP_ASK_STYLE)
+
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def load_state(uid: int) -> Dict[str, Any]:
-    row = db_exec("SELECT intent, step, data FROM user_state WHERE user_id=:uid", {"uid": uid}).mappings().first()
+# Для health-эндпоинтов хватает секундной точности: строку пересобираем
+# не чаще раза в секунду, а не на каждый пинг балансировщика.
+_iso_tick = (0.0, "")
+
+def now_iso_coarse() -> str:
+    global _iso_tick
+    t = time.monotonic()
+    if t - _iso_tick[0] >= 1.0:
+        _iso_tick = (t, _now_iso())
+    return _iso_tick[1]
+
+def _row_to_state(uid: int, row) -> Dict[str, Any]:
     if row:
-        data = {}
-        if row["data"]:
-            try:
-                data = json.loads(row["data"])
-            except Exception as e:
-                logging.error("parse user data error: %s", e)
-                data = {}
+        data = row["data"] if isinstance(row["data"], dict) else {}
         data.setdefault("history", [])
         return {"user_id": uid, "intent": row["intent"] or INTENT_GREET, "step": row["step"] or STEP_ASK_STYLE, "data": data}
     return {"user_id": uid, "intent": INTENT_GREET, "step": STEP_ASK_STYLE, "data": {"history": []}}
 
+# Кэш состояний на время обработки одного апдейта: повторные load_state
+# внутри хендлера не ходят в БД, save_state кладёт сюда итог из RETURNING.
+_state_cache: ContextVar[Optional[Dict[int, Dict[str, Any]]]] = ContextVar("state_cache", default=None)
+
+def _cache_state(st: Dict[str, Any]):
+    cache = _state_cache.get()
+    if cache is not None:
+        cache[st["user_id"]] = copy.deepcopy(st)
+
+def load_state(uid: int) -> Dict[str, Any]:
+    cache = _state_cache.get()
+    if cache is not None and uid in cache:
+        return copy.deepcopy(cache[uid])
+    row = db_exec(_SQL_LOAD_STATE, {"uid": uid}).mappings().first()
+    st = _row_to_state(uid, row)
+    _cache_state(st)
+    return st
+
 def save_state(uid: int, intent: Optional[str] = None, step: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    cur = load_state(uid)
-    intent = intent or cur["intent"]
-    step   = step   or cur["step"]
-    new_data = cur["data"].copy()
-    if data:
-        new_data.update(data)
-    new_data["last_state_write_at"] = _now_iso()
-    db_exec("""
-        INSERT INTO user_state (user_id, intent, step, data, updated_at)
-        VALUES (:uid, :intent, :step, :data, now())
-        ON CONFLICT (user_id) DO UPDATE
-        SET intent=EXCLUDED.intent, step=EXCLUDED.step, data=EXCLUDED.data, updated_at=now()
-    """, {"uid": uid, "intent": intent, "step": step, "data": json.dumps(new_data, ensure_ascii=False)})
-    return {"user_id": uid, "intent": intent, "step": step, "data": new_data}
+    # один запрос: слияние data делает Postgres (jsonb ||), итог возвращает RETURNING
+    patch = dict(data or {})
+    patch["last_state_write_at"] = _now_iso()
+    db_mark_write()
+    row = db_exec(_SQL_SAVE_STATE, {
+        "uid": uid, "intent": intent or None, "step": step or None,
+        "data": orjson.dumps(patch).decode("utf-8"),
+    }).mappings().first()
+    st = _row_to_state(uid, row)
+    _cache_state(st)
+    return st
 
 def _append_history(data: Dict[str, Any], role: str, content: str) -> Dict[str, Any]:
     hist = data.get("history", [])
@@ -206,8 +410,29 @@ def _append_history(data: Dict[str, Any], role: str, content: str) -> Dict[str,
     return data
 
 # ========= Flask/TeleBot =========
+# Одна сессия с пулом соединений на все потоки: TCP+TLS до api.telegram.org
+# переиспользуются, а не открываются заново в каждом воркере.
+# Повторяем только неудачный connect (DNS, отказ/таймаут соединения): запрос ещё
+# не ушёл, дубля не будет. Всё, что случилось после отправки, не ретраим — включая
+# keep-alive, закрытый сервером (RemoteDisconnected/ProtocolError urllib3 считает
+# ошибкой чтения): sendMessage не идемпотентен, такой вызов просто вернёт ошибку.
+_tg_retry = Retry(total=2, connect=2, read=0, status=0, other=0, redirect=0, backoff_factor=0.2)
+_tg_session = requests.Session()
+_tg_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_tg_retry))
+apihelper.session = _tg_session
+
 bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML", threaded=False)
+
+# jsonify (ответ в теле вебхука, health-эндпоинты) — через orjson
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 MAIN_MENU = types.ReplyKeyboardMarkup(resize_keyboard=True)
 MAIN_MENU.row("🚑 У меня ошибка", "🧩 Хочу стратегию")
@@ -217,7 +442,405 @@ MAIN_MENU.row("🆘 Экстренно", "🤔 Не знаю, с чего нач
 STYLE_KB = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
 STYLE_KB.row("ты", "вы")
 
+# Инлайн-клавиатуры тоже статичны — собираем один раз при импорте
+CONFIRM_KB = types.InlineKeyboardMarkup().row(
+    types.InlineKeyboardButton("Да, верно", callback_data="confirm_problem"),
+    types.InlineKeyboardButton("Чуть иначе", callback_data="refine_problem"),
+)
+STRUCT_KB = types.InlineKeyboardMarkup().row(
+    types.InlineKeyboardButton("Разобрать по шагам", callback_data="start_error_flow"),
+    types.InlineKeyboardButton("Пока нет", callback_data="skip_error_flow"),
+)
+RESUME_KB = types.InlineKeyboardMarkup().row(
+    types.InlineKeyboardButton("Продолжаем", callback_data="continue_session"),
+)
+RESUME_OR_RESET_KB = types.InlineKeyboardMarkup().row(
+    types.InlineKeyboardButton("Продолжаем", callback_data="continue_session"),
+    types.InlineKeyboardButton("Начать заново", callback_data="restart_session"),
+)
+
+# JSON клавиатур тоже считаем один раз: telebot строку шлёт как есть,
+# в тело вебхука она уходит через orjson.Fragment без повторного разбора
+def _markup_dumps(markup) -> str:
+    # компактный UTF-8 вместо \uXXXX-эскейпов json.dumps из telebot
+    return orjson.dumps(orjson.loads(markup.to_json())).decode("utf-8")
+
+MARKUP_JSON = {id(kb): _markup_dumps(kb) for kb in (MAIN_MENU, STYLE_KB, CONFIRM_KB, STRUCT_KB, RESUME_KB, RESUME_OR_RESET_KB)}
+
+def markup_json(markup) -> str:
+    return MARKUP_JSON.get(id(markup)) or _markup_dumps(markup)
+
+# ========= Outbox (ответ в теле вебхука) =========
+# Хендлеры пишут через send(): за время апдейта сообщения копятся, соседние
+# сообщения одному чату склеиваются в одно (если не конфликтуют клавиатуры),
+# и в конце уходят разом. В синхронном режиме последнее сообщение отдаём
+# Telegram прямо в теле 200-ответа (минус один исходящий HTTPS-запрос).
+TG_TEXT_LIMIT = 4096
+_outbox = threading.local()
+
+# Token bucket'ы на исходящие: глобальный (30 msg/s Telegram) и на чат
+# (~1 msg/s с небольшим всплеском) — не ловим шторм 429 при всплеске апдейтов.
+_send_lock = threading.Lock()
+_send_bucket = [TG_SEND_RATE, time.monotonic()]  # [токены, время пополнения]
+_chat_buckets: Dict[int, List[float]] = {}
+
+def _bucket_take(bucket: List[float], rate: float, burst: float, now: float) -> float:
+    # 0 — токен взят, иначе сколько ждать до следующего
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return (1 - bucket[0]) / rate
+
+def _send_wait(chat_id: Optional[int] = None):
+    while True:
+        with _send_lock:
+            now = time.monotonic()
+            wait = 0.0
+            if chat_id is not None:
+                bucket = _chat_buckets.get(chat_id)
+                if bucket is None:
+                    if len(_chat_buckets) > 10000:  # полные (давно молчащие) чаты не храним
+                        idle = TG_CHAT_BURST / TG_CHAT_RATE
+                        for k in [k for k, b in _chat_buckets.items() if now - b[1] > idle]:
+                            del _chat_buckets[k]
+                    bucket = _chat_buckets[chat_id] = [TG_CHAT_BURST, now]
+                wait = _bucket_take(bucket, TG_CHAT_RATE, TG_CHAT_BURST, now)
+                if wait == 0.0:
+                    wait = _bucket_take(_send_bucket, TG_SEND_RATE, TG_SEND_RATE, now)
+                    if wait:  # глобальный пуст — вернём токен чата, подождём
+                        bucket[0] += 1
+            else:
+                wait = _bucket_take(_send_bucket, TG_SEND_RATE, TG_SEND_RATE, now)
+            if not wait:
+                return
+        time.sleep(wait)
+
+def tg_send(chat_id: int, text_out: str, **kw):
+    _send_wait(chat_id)
+    if kw.get("reply_markup") is not None:
+        kw["reply_markup"] = markup_json(kw["reply_markup"])
+    return bot.send_message(chat_id, text_out, **kw)
+
+def _deliver(msg: Dict[str, Any]):
+    kw = {k: v for k, v in msg.items() if k not in ("chat_id", "text")}
+    tg_send(msg["chat_id"], msg["text"], **kw)
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+HTML_TAG_RESERVE = 64  # запас под закрывающие/переоткрытые теги в каждом куске
+
+def _balance_tags(parts: List[str]) -> List[str]:
+    # тег, открытый на границе куска, закрываем в нём и переоткрываем в следующем
+    out, stack = [], []
+    for part in parts:
+        prefix = "".join(tag for _, tag in stack)
+        for m in _TAG_RE.finditer(part):
+            name = m.group(2).lower()
+            if not m.group(1):
+                stack.append((name, m.group(0)))
+                continue
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    del stack[i]
+                    break
+        out.append(prefix + part + "".join(f"</{name}>" for name, _ in reversed(stack)))
+    return out
+
+_ENTITY_RE = re.compile(r"&#?[A-Za-z0-9]+;")
+
+def _tag_start(text_out: str, pos: int) -> int:
+    # начало тега — только «<» перед буквой или «/»: «a < b» в тексте коуча — не тег
+    i = text_out.rfind("<", 0, pos)
+    while i >= 0:
+        nxt = text_out[i + 1:i + 2]
+        if nxt == "/" or (nxt.isascii() and nxt.isalpha()):
+            return i
+        i = text_out.rfind("<", 0, i)
+    return -1
+
+def _in_tag(text_out: str, pos: int) -> bool:
+    start = _tag_start(text_out, pos)
+    return start >= 0 and text_out.find(">", start, pos) < 0
+
+def _entity_start(text_out: str, pos: int) -> int:
+    # позиция «&», если pos попал внутрь сущности вида &amp; / &#39;, иначе -1
+    amp = text_out.rfind("&", max(0, pos - 10), pos)
+    if amp < 0:
+        return -1
+    m = _ENTITY_RE.match(text_out, amp)
+    return amp if m and m.end() > pos else -1
+
+def _split_plain(text_out: str, room: int) -> List[str]:
+    parts = []
+    while len(text_out) > room:
+        for sep in ("\n", " "):
+            cut = text_out.rfind(sep, 0, room)
+            while cut > 0 and _in_tag(text_out, cut):  # пробел внутри тега — не граница
+                cut = text_out.rfind(sep, 0, _tag_start(text_out, cut))
+            if cut > 0:
+                skip = 1
+                break
+        else:
+            cut, skip = room, 0
+            if _in_tag(text_out, cut) and _tag_start(text_out, cut) > 0:
+                cut = _tag_start(text_out, cut)
+            if _entity_start(text_out, cut) > 0:  # &amp; пополам Telegram не разберёт
+                cut = _entity_start(text_out, cut)
+        parts.append(text_out[:cut])
+        text_out = text_out[cut + skip:]
+    parts.append(text_out)
+    return parts
+
+def split_message(text_out: str, limit: int = TG_TEXT_LIMIT) -> List[str]:
+    # режем по последнему переводу строки (или пробелу) до лимита Telegram;
+    # HTML-разметку балансируем по кускам (parse_mode=HTML)
+    if "<" not in text_out:
+        return _split_plain(text_out, limit)
+    reserve = HTML_TAG_RESERVE
+    while True:
+        parts = _balance_tags(_split_plain(text_out, limit - reserve))
+        if reserve >= limit // 2 or all(len(p) <= limit for p in parts):
+            return parts
+        reserve *= 2  # глубокая вложенность не влезла в запас — режем мельче
+
+def _can_merge(prev: Dict[str, Any], chat_id: int, text_out: str, kw: Dict[str, Any]) -> bool:
+    if prev["chat_id"] != chat_id or kw.get("reply_to_message_id"):
+        return False
+    if prev.get("reply_markup") is not None and prev.get("reply_markup") is not kw.get("reply_markup"):
+        return False
+    return len(prev["text"]) + 2 + len(text_out) <= TG_TEXT_LIMIT
+
+def send(chat_id: int, text_out: str, **kw):
+    if len(text_out) > TG_TEXT_LIMIT:
+        # длинный ответ — несколько сообщений: reply_to на первом, клавиатура на последнем
+        parts = split_message(text_out)
+        markup = kw.pop("reply_markup", None)
+        reply_to = kw.pop("reply_to_message_id", None)
+        for i, part in enumerate(parts):
+            pkw = dict(kw)
+            if i == 0 and reply_to:
+                pkw["reply_to_message_id"] = reply_to
+            if i == len(parts) - 1 and markup is not None:
+                pkw["reply_markup"] = markup
+            send(chat_id, part, **pkw)
+        return
+    pending = getattr(_outbox, "pending", None)
+    if pending is None:  # вне вебхука (напоминания и т.п.)
+        tg_send(chat_id, text_out, **kw)
+        return
+    if pending and _can_merge(pending[-1], chat_id, text_out, kw):
+        prev = pending[-1]
+        prev["text"] = prev["text"] + "\n\n" + text_out
+        if kw.get("reply_markup") is not None:
+            prev["reply_markup"] = kw["reply_markup"]
+        return
+    pending.append({"chat_id": chat_id, "text": text_out, **kw})
+
+def _outbox_open():
+    _outbox.pending = []
+
+def _outbox_discard():
+    _outbox.pending = None
+
+def _outbox_close(flush: bool = False) -> Optional[Dict[str, Any]]:
+    pending = getattr(_outbox, "pending", None) or []
+    _outbox.pending = None
+    if not pending:
+        return None
+    if flush:
+        for msg in pending:
+            _deliver(msg)
+        return None
+    for msg in pending[:-1]:
+        _deliver(msg)
+    msg = pending[-1]
+    payload = {"method": "sendMessage", "chat_id": msg["chat_id"], "text": msg["text"], "parse_mode": "HTML"}
+    if msg.get("reply_markup") is not None:
+        payload["reply_markup"] = orjson.Fragment(markup_json(msg["reply_markup"]))
+    if msg.get("reply_to_message_id"):
+        payload["reply_to_message_id"] = msg["reply_to_message_id"]
+    return payload
+
+# ========= GPT: кэш ответов =========
+# Ключ — sha256(model|messages|temperature), реплики пользователя в ключе
+# нормализованы (регистр, пробелы). Одинаковый диалог
+# (повторные ретраи Telegram, одинаковые первые реплики) не гоняем в OpenAI второй раз.
+_gpt_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, raw)
+_gpt_cache_lock = threading.Lock()
+
+def _norm_for_key(text_in: str) -> str:
+    # «Снял стоп» и «снял  стоп» — одна реплика; пунктуацию не трогаем:
+    # «Снял стоп?» (вопрос) и «Снял стоп.» (факт) — разные ответы коуча
+    return " ".join((text_in or "").casefold().split())
+
+def _cache_key(model: str, msgs: List[Dict[str, str]], temperature: float) -> str:
+    norm = [{"role": m["role"], "content": _norm_for_key(m["content"])} if m.get("role") == "user" else m for m in msgs]
+    raw = orjson.dumps([model, norm, temperature], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    with _gpt_cache_lock:
+        item = _gpt_cache.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():  # протухло — промпты/модель могли смениться
+            del _gpt_cache[key]
+            return None
+        _gpt_cache.move_to_end(key)
+        return item[1]
+
+def _cache_set(key: str, val: str):
+    with _gpt_cache_lock:
+        _gpt_cache[key] = (time.monotonic() + GPT_CACHE_TTL, val)
+        _gpt_cache.move_to_end(key)
+        while len(_gpt_cache) > GPT_CACHE_SIZE:
+            _gpt_cache.popitem(last=False)
+
+def _typing(chat_id: int):
+    # сразу показываем «печатает…», пока ждём модель: ответ уйдёт только в конце апдейта
+    try:
+        _send_wait()
+        bot.send_chat_action(chat_id, "typing")
+    except Exception as e:
+        logging.error("send_chat_action error: %s", e)
+
+# Воркеров больше, чем разумно держать запросов к OpenAI: лишние ждут слот,
+# а не ловят 429 по RPM. Не дождались — ошибка, у вызывающего есть fallback.
+_oai_slots = threading.BoundedSemaphore(OPENAI_CONCURRENCY)
+
+# Лимиты окна OpenAI по заголовкам x-ratelimit-* последнего ответа: кончились
+# запросы/токены — следующие вызовы ждут сброса окна, а не ловят 429 с ретраями.
+_RL_DUR_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_RL_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+_oai_rl: Dict[str, Optional[float]] = {"req_left": None, "tok_left": None, "req_reset": 0.0, "tok_reset": 0.0}
+_oai_rl_lock = threading.Lock()
+
+def _rl_seconds(value: Optional[str]) -> float:
+    # «1s», «6m0s», «120ms» → секунды
+    return sum(float(n) * _RL_UNITS[u] for n, u in _RL_DUR_RE.findall(value or ""))
+
+def _est_tokens(msgs: List[Dict[str, str]], max_tokens: int = GPT_MAX_TOKENS) -> int:
+    # грубо: ~3 символа кириллицы на токен + запас под ответ
+    return sum(len(m.get("content") or "") for m in msgs) // 3 + max_tokens
+
+def _oai_throttle(est: int):
+    with _oai_rl_lock:
+        now = time.monotonic()
+        wait = 0.0
+        if _oai_rl["req_left"] is not None:
+            if _oai_rl["req_left"] <= 0 and _oai_rl["req_reset"] > now:
+                wait = _oai_rl["req_reset"] - now
+            _oai_rl["req_left"] -= 1  # бронируем, чтобы параллельные вызовы не выбрали один остаток
+        if _oai_rl["tok_left"] is not None:
+            if _oai_rl["tok_left"] < est and _oai_rl["tok_reset"] > now:
+                wait = max(wait, _oai_rl["tok_reset"] - now)
+            _oai_rl["tok_left"] -= est
+    if wait > 0:
+        time.sleep(min(wait, 20.0))
+
+def _oai_note_limits(headers):
+    try:
+        now = time.monotonic()
+        with _oai_rl_lock:
+            if headers.get("x-ratelimit-remaining-requests") is not None:
+                _oai_rl["req_left"] = int(headers["x-ratelimit-remaining-requests"])
+                _oai_rl["req_reset"] = now + _rl_seconds(headers.get("x-ratelimit-reset-requests"))
+            if headers.get("x-ratelimit-remaining-tokens") is not None:
+                _oai_rl["tok_left"] = int(headers["x-ratelimit-remaining-tokens"])
+                _oai_rl["tok_reset"] = now + _rl_seconds(headers.get("x-ratelimit-reset-tokens"))
+            retry_after = headers.get("retry-after")
+            if retry_after:  # 429 — до Retry-After окно считаем пустым
+                _oai_rl["req_left"] = 0
+                _oai_rl["req_reset"] = max(_oai_rl["req_reset"] or 0.0, now + float(retry_after))
+    except (ValueError, TypeError) as e:
+        logging.error("ratelimit headers parse error: %s", e)
+
+def _gpt_complete(msgs: List[Dict[str, str]], temperature: float, max_tokens: int):
+    _oai_throttle(_est_tokens(msgs, max_tokens))
+    if not _oai_slots.acquire(timeout=20):
+        raise RuntimeError("OpenAI busy: no free slot")
+    try:
+        resp = oai_client.chat.completions.with_raw_response.create(
+            model=OPENAI_MODEL,
+            messages=msgs,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format={"type":"json_object"},
+        )
+    except RateLimitError as e:
+        _oai_note_limits(e.response.headers)
+        raise
+    finally:
+        _oai_slots.release()
+    _oai_note_limits(resp.headers)
+    return resp.parse().choices[0]
+
+def gpt_json(msgs: List[Dict[str, str]], temperature: float, chat_id: Optional[int] = None) -> Dict[str, Any]:
+    key = _cache_key(OPENAI_MODEL, msgs, temperature)
+    raw = _cache_get(key)
+    if raw is None:
+        db_release()
+        if chat_id is not None:
+            _typing(chat_id)
+        choice = _gpt_complete(msgs, temperature, GPT_MAX_TOKENS)
+        if choice.finish_reason == "length":
+            # JSON обрезан на лимите (русский текст длиннее в токенах) — одна попытка с запасом
+            logging.warning("GPT reply hit max_tokens=%s, retrying with %s", GPT_MAX_TOKENS, GPT_MAX_TOKENS * 2)
+            choice = _gpt_complete(msgs, temperature, GPT_MAX_TOKENS * 2)
+        raw = choice.message.content or "{}"
+        js = orjson.loads(raw)
+        _cache_set(key, raw)
+        return js
+    return orjson.loads(raw)
+
 # ========= GPT: коуч-слой =========
+# Приветствия, «спасибо», одни эмодзи/знаки — модели тут нечего уточнять,
+# отвечаем шаблонным вопросом без запроса в OpenAI. «Ок»/«ага» сюда не входят:
+# это ответ да/нет, а цифры («3», «50%», «2:1») — ответ на вопрос коуча.
+SMALLTALK = frozenset({
+    "привет", "приветик", "здравствуй", "здравствуйте", "добрый день", "добрый вечер", "доброе утро",
+    "hi", "hello", "спасибо", "спс", "благодарю", "пока",
+})
+
+def is_smalltalk(text_in: str) -> bool:
+    t = (text_in or "").lower().strip(" .,!?)(")
+    return t in SMALLTALK or not any(ch.isalnum() for ch in t)
+
+def answers_question(history: List[Dict[str, str]], text_in: str) -> bool:
+    # последняя реплика коуча перед текущей — вопрос: пользователь отвечает на него
+    prev = history
+    if prev and prev[-1] == {"role": "user", "content": text_in}:
+        prev = prev[:-1]
+    return bool(prev) and prev[-1].get("role") == "assistant" and "?" in (prev[-1].get("content") or "")
+
+# Статичный системный промпт — одинаковый префикс у всех запросов, OpenAI
+# кэширует его автоматически. Пользовательское (стиль) идёт отдельным сообщением.
+COACH_SYSTEM = """
+Ты — Алекс, коуч-наставник. Говоришь просто и по-человечески.
+Задача: углубляться короткими вопросами (ОДИН вопрос за ход), подводить к чёткому резюме проблемы.
+Никаких советов и слов «техника». Сначала: калибровка → резюме → подтверждение.
+Когда уверен, что человек назвал проблему — readiness_score ближе к 1.0.
+Если можно — верни summary_draft (1–2 строки) и ask_confirm=true.
+Ответ — JSON: response_text, store, summary_draft, readiness_score, ask_confirm.
+""".strip()
+
+def _context_window(history: List[Dict[str, str]], text_in: str) -> List[Dict[str, str]]:
+    # хвост истории в пределах GPT_CONTEXT_CHARS; текущая реплика обычно уже
+    # последняя в истории (handle_text дописывает её до вызова) — не дублируем
+    turns = [h for h in history[-HIST_LIMIT:] if h.get("role") in ("user", "assistant")]
+    if not turns or turns[-1] != {"role": "user", "content": text_in}:
+        turns.append({"role": "user", "content": text_in})
+    out: List[Dict[str, str]] = []
+    budget = GPT_CONTEXT_CHARS
+    for h in reversed(turns):
+        budget -= len(h["content"])
+        if budget < 0 and out:
+            break
+        out.append(h)
+    out.reverse()
+    return out
+
 def gpt_calibrate(uid: int, text_in: str, st: Dict[str, Any]) -> Dict[str, Any]:
     fallback = {
         "response_text": "Окей. Чтобы не спешить, скажи коротко: где именно начинает уводить от плана — вход, стоп или выход?",
@@ -228,34 +851,18 @@ def gpt_calibrate(uid: int, text_in: str, st: Dict[str, Any]) -> Dict[str, Any]:
     }
     if not oai_client or not OFFSCRIPT_ENABLED:
         return fallback
-
     style = st["data"].get("style", "ты")
     history = st["data"].get("history", [])
+    if is_smalltalk(text_in) and not answers_question(history, text_in):
+        return fallback
 
-    system = f"""
-Ты — Алекс, коуч-наставник. Говоришь на «{style}», просто и по-человечески.
-Задача: углубляться короткими вопросами (ОДИН вопрос за ход), подводить к чёткому резюме проблемы.
-Никаких советов и слов «техника». Сначала: калибровка → резюме → подтверждение.
-Когда уверен, что человек назвал проблему — readiness_score ближе к 1.0.
-Если можно — верни summary_draft (1–2 строки) и ask_confirm=true.
-Ответ — JSON: response_text, store, summary_draft, readiness_score, ask_confirm.
-""".strip()
-
-    msgs = [{"role": "system", "content": system}]
-    for h in history[-HIST_LIMIT:]:
-        if h.get("role") in ("user", "assistant"):
-            msgs.append(h)
-    msgs.append({"role": "user", "content": text_in})
+    msgs = [
+        {"role": "system", "content": COACH_SYSTEM},
+        {"role": "system", "content": f"Обращайся к собеседнику на «{style}»."},
+    ] + _context_window(history, text_in)
 
     try:
-        res = oai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=msgs,
-            temperature=0.3,
-            response_format={"type":"json_object"},
-        )
-        raw = res.choices[0].message.content or "{}"
-        js = json.loads(raw)
+        js = gpt_json(msgs, 0.3, chat_id=uid)
         for k in ["response_text","store","summary_draft","readiness_score","ask_confirm"]:
             if k not in js:
                 return fallback
@@ -296,23 +903,75 @@ def extract_summary_from_memory(data: Dict[str, Any]) -> str:
 def cmd_start(m: types.Message):
     uid = m.from_user.id
     st = save_state(uid, INTENT_GREET, STEP_ASK_STYLE, {"history": []})
-    bot.send_message(uid,
+    send(uid,
         "👋 Привет! Как удобнее — <b>ты</b> или <b>вы</b>?\n\nЕсли захочешь начать с чистого листа — напиши: <b>новый разбор</b>.",
         reply_markup=STYLE_KB
     )
 
 @bot.message_handler(commands=["version","v"])
 def cmd_version(m: types.Message):
-    bot.reply_to(m, (
+    send(m.chat.id, (
         f"🔄 Версия бота: {BOT_VERSION}\n"
-        f"📝 Хэш кода: {_code_hash()}\n"
-        f"🕒 Время сервера: {datetime.now(timezone.utc).isoformat()}\n"
+        f"📝 Хэш кода: {CODE_HASH}\n"
+        f"🕒 Время сервера: {now_iso_coarse()}\n"
         f"🤖 OpenAI: {openai_status}"
-    ))
+    ), reply_to_message_id=m.message_id)
 
 @bot.message_handler(commands=["menu"])
 def cmd_menu(m: types.Message):
-    bot.send_message(m.chat.id, "Меню:", reply_markup=MAIN_MENU)
+    send(m.chat.id, "Меню:", reply_markup=MAIN_MENU)
+
+# ========= Menu =========
+# Кнопки разбираются одной проверкой по словарю и регистрируются раньше on_text:
+# telebot берёт первый подходящий хендлер, и свободный текст не должен их перехватывать.
+def btn_error(uid: int, st: Dict[str, Any]):
+    if st["data"].get("problem_confirmed"):
+        save_state(uid, INTENT_ERR, STEP_ERR_DESCR, st["data"])
+        send(uid, "Опиши последний кейс ошибки: где/когда, вход/стоп/план, где отступил, чем закончилось.")
+    else:
+        save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
+        send(uid, "Коротко — что именно сейчас мешает? Сформулируй в одном-двух предложениях.", reply_markup=MAIN_MENU)
+
+def btn_start_help(uid: int, st: Dict[str, Any]):
+    send(uid, "План: 1) быстрый разбор проблемы, 2) фокус недели, 3) скелет ТС. С чего начнём?", reply_markup=MAIN_MENU)
+    save_state(uid, data=st["data"])
+
+def btn_not_ready(uid: int, st: Dict[str, Any]):
+    send(uid, "Ок. Если хочешь ускориться — нажми «🚑 У меня ошибка».", reply_markup=MAIN_MENU)
+    save_state(uid, data=st["data"])
+
+MENU_BUTTONS = (
+    ("🚑 У меня ошибка", btn_error),
+    ("🧩 Хочу стратегию", btn_not_ready),
+    ("📄 Паспорт", btn_not_ready),
+    ("🗒 Панель недели", btn_not_ready),
+    ("🆘 Экстренно", btn_not_ready),
+    ("🤔 Не знаю, с чего начать", btn_start_help),
+)
+# срезаем только эмодзи самих кнопок: «📉 Хочу стратегию ...» — уже свободный текст
+_BUTTON_PREFIXES = frozenset(label.split(" ", 1)[0] for label, _ in MENU_BUTTONS)
+
+def button_key(text_in: str) -> str:
+    # «🚑 У меня ошибка», «у меня  ошибка », «У МЕНЯ ОШИБКА» — одна кнопка:
+    # эмодзи кнопки (и U+FE0F после него), регистр, ё и пробелы нормализованы,
+    # дальше сравнивается вся надпись целиком
+    t = " ".join((text_in or "").replace("\ufe0f", "").translate(_YO_TABLE).split())
+    head, _, rest = t.partition(" ")
+    if rest and head in _BUTTON_PREFIXES:
+        t = rest
+    return t.casefold()
+
+BUTTON_TABLE = {button_key(label): fn for label, fn in MENU_BUTTONS}
+
+@bot.message_handler(func=lambda m: button_key(m.text) in BUTTON_TABLE)
+def on_button(m: types.Message):
+    uid = m.from_user.id
+    handler = BUTTON_TABLE.get(button_key(m.text))
+    if handler is None:
+        return
+    st = load_state(uid)
+    st["data"] = _append_history(st["data"], "user", m.text.strip())
+    handler(uid, st)
 
 @bot.message_handler(content_types=["text"])
 def on_text(m: types.Message):
@@ -320,13 +979,18 @@ def on_text(m: types.Message):
     text_in = (m.text or "").strip()
     handle_text(uid, text_in, m)
 
+# Ключевые фразы — точное совпадение после нормализации, один lookup по множеству
+RESET_PHRASES = frozenset({"новый разбор", "новый", "с чистого листа", "start over"})
+STYLE_CHOICES = frozenset({"ты", "вы"})
+
 def handle_text(uid: int, text_in: str, original_message: Optional[types.Message] = None):
     st = load_state(uid)
     logging.info("User %s: intent=%s step=%s text='%s'", uid, st["intent"], st["step"], text_in[:200])
+    low = " ".join(text_in.translate(_YO_TABLE).casefold().split())
 
-    if text_in.lower() in ("новый разбор","новый","с чистого листа","start over"):
+    if low in RESET_PHRASES:
         st = save_state(uid, INTENT_FREE, STEP_FREE_CHAT, {"history": [], "coach_turns": 0, "struct_offer_shown": False})
-        bot.send_message(uid, "Окей, чистый лист. Что сейчас хочется поправить в трейдинге?", reply_markup=MAIN_MENU)
+        send(uid, "Окей, чистый лист. Что сейчас хочется поправить в трейдинге?", reply_markup=MAIN_MENU)
         return
 
     st["data"] = _append_history(st["data"], "user", text_in)
@@ -334,13 +998,13 @@ def handle_text(uid: int, text_in: str, original_message: Optional[types.Message
     st["data"]["awaiting_reply"] = True
 
     if st["intent"] == INTENT_GREET and st["step"] == STEP_ASK_STYLE:
-        if text_in.lower() in ("ты","вы"):
-            st["data"]["style"] = text_in.lower()
+        if low in STYLE_CHOICES:
+            st["data"]["style"] = low
             st = save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
-            bot.send_message(uid, f"Принято ({text_in}). Начнём спокойно и без спешки. Что сейчас больше всего мешает?", reply_markup=MAIN_MENU)
+            send(uid, f"Принято ({text_in}). Начнём спокойно и без спешки. Что сейчас больше всего мешает?", reply_markup=MAIN_MENU)
         else:
             save_state(uid, data=st["data"])
-            bot.send_message(uid, "Выбери «ты» или «вы».", reply_markup=STYLE_KB)
+            send(uid, "Выбери «ты» или «вы».", reply_markup=STYLE_KB)
         return
 
     if st["intent"] == INTENT_ERR:
@@ -366,16 +1030,12 @@ def handle_text(uid: int, text_in: str, original_message: Optional[types.Message
     st = save_state(uid, INTENT_FREE, STEP_FREE_CHAT, mem)
 
     if original_message:
-        bot.reply_to(original_message, resp, reply_markup=MAIN_MENU)
+        send(uid, resp, reply_markup=MAIN_MENU, reply_to_message_id=original_message.message_id)
     else:
-        bot.send_message(uid, resp, reply_markup=MAIN_MENU)
+        send(uid, resp, reply_markup=MAIN_MENU)
 
     if decision.get("ask_confirm") and mem.get("problem_draft"):
-        kb = types.InlineKeyboardMarkup().row(
-            types.InlineKeyboardButton("Да, верно", callback_data="confirm_problem"),
-            types.InlineKeyboardButton("Чуть иначе", callback_data="refine_problem")
-        )
-        bot.send_message(uid, f"Суммирую коротко:\n\n<b>{mem['problem_draft']}</b>\n\nПодходит?", reply_markup=kb)
+        send(uid, f"Суммирую коротко:\n\n<b>{mem['problem_draft']}</b>\n\nПодходит?", reply_markup=CONFIRM_KB)
         return
 
     if mem.get("problem_confirmed"):
@@ -389,11 +1049,7 @@ def handle_text(uid: int, text_in: str, original_message: Optional[types.Message
                 mem["problem_draft"] = auto
                 save_state(uid, data=mem)
         if mem.get("problem_draft"):
-            kb = types.InlineKeyboardMarkup().row(
-                types.InlineKeyboardButton("Да, верно", callback_data="confirm_problem"),
-                types.InlineKeyboardButton("Чуть иначе", callback_data="refine_problem")
-            )
-            bot.send_message(uid, f"Суммирую:\n\n<b>{mem['problem_draft']}</b>\n\nПодходит?", reply_markup=kb)
+            send(uid, f"Суммирую:\n\n<b>{mem['problem_draft']}</b>\n\nПодходит?", reply_markup=CONFIRM_KB)
 
 def offer_structure(uid: int, st: Dict[str, Any]):
     data = st["data"]
@@ -401,11 +1057,7 @@ def offer_structure(uid: int, st: Dict[str, Any]):
         return
     data["struct_offer_shown"] = True
     save_state(uid, data=data)
-    kb = types.InlineKeyboardMarkup().row(
-        types.InlineKeyboardButton("Разобрать по шагам", callback_data="start_error_flow"),
-        types.InlineKeyboardButton("Пока нет", callback_data="skip_error_flow")
-    )
-    bot.send_message(uid, "Готов разобрать это по шагам (коротко и без спешки)?", reply_markup=kb)
+    send(uid, "Готов разобрать это по шагам (коротко и без спешки)?", reply_markup=STRUCT_KB)
 
 def proceed_struct(uid: int, text_in: str, st: Dict[str, Any]):
     step = st["step"]
@@ -414,32 +1066,22 @@ def proceed_struct(uid: int, text_in: str, st: Dict[str, Any]):
     if step == STEP_ERR_DESCR:
         data["error_description"] = text_in
         save_state(uid, INTENT_ERR, STEP_MER_CTX, data)
-        bot.send_message(uid, "Зафиксируем картинку. Где и когда это было? Коротко.", reply_markup=MAIN_MENU)
+        send(uid, STEP_PROMPTS[STEP_MER_CTX], reply_markup=MAIN_MENU)
         return
 
     if step in MER_ORDER:
         mer = data.get("mer", {})
         mer[step] = text_in
         data["mer"] = mer
-        idx = MER_ORDER.index(step)
-        if idx + 1 < len(MER_ORDER):
-            nxt = MER_ORDER[idx + 1]
-            save_state(uid, INTENT_ERR, nxt, data)
-            bot.send_message(uid, {
-                STEP_MER_CTX: "Зафиксируем картинку. Где и когда это было? Коротко.",
-                STEP_MER_EMO: "Что почувствовал в моменте (2–3 слова)?",
-                STEP_MER_THO: "Какие мысли мелькали (2–3 коротких фразы)?",
-                STEP_MER_BEH: "Что сделал фактически? Действия.",
-            }[nxt], reply_markup=MAIN_MENU)
-        else:
-            save_state(uid, INTENT_ERR, STEP_GOAL, data)
-            bot.send_message(uid, "Сформулируй позитивную цель: что будешь делать вместо прежнего поведения?", reply_markup=MAIN_MENU)
+        nxt = MER_NEXT[step]
+        save_state(uid, INTENT_ERR, nxt, data)
+        send(uid, STEP_PROMPTS[nxt], reply_markup=MAIN_MENU)
         return
 
     if step == STEP_GOAL:
         data["goal"] = text_in
         save_state(uid, INTENT_ERR, STEP_TOTE_OPS, data)
-        bot.send_message(uid, "Для ближайших 3 сделок назови 2–3 конкретных шага (коротко, списком).", reply_markup=MAIN_MENU)
+        send(uid, STEP_PROMPTS[STEP_TOTE_OPS], reply_markup=MAIN_MENU)
         return
 
     if step == STEP_TOTE_OPS:
@@ -447,7 +1089,7 @@ def proceed_struct(uid: int, text_in: str, st: Dict[str, Any]):
         tote["ops"] = text_in
         data["tote"] = tote
         save_state(uid, INTENT_ERR, STEP_TOTE_TEST, data)
-        bot.send_message(uid, "Как поймёшь, что получилось? Один простой критерий.", reply_markup=MAIN_MENU)
+        send(uid, STEP_PROMPTS[STEP_TOTE_TEST], reply_markup=MAIN_MENU)
         return
 
     if step == STEP_TOTE_TEST:
@@ -455,7 +1097,7 @@ def proceed_struct(uid: int, text_in: str, st: Dict[str, Any]):
         tote["test"] = text_in
         data["tote"] = tote
         save_state(uid, INTENT_ERR, STEP_TOTE_EXIT, data)
-        bot.send_message(uid, "Если проверка покажет «не получилось» — что сделаешь?", reply_markup=MAIN_MENU)
+        send(uid, STEP_PROMPTS[STEP_TOTE_EXIT], reply_markup=MAIN_MENU)
         return
 
     if step == STEP_TOTE_EXIT:
@@ -477,97 +1119,178 @@ def proceed_struct(uid: int, text_in: str, st: Dict[str, Any]):
             f"Если не вышло: {data.get('tote', {}).get('exit', '—')}",
         ]
         save_state(uid, INTENT_DONE, STEP_FREE_CHAT, data)
-        bot.send_message(uid, "\n".join(summary), reply_markup=MAIN_MENU)
-        bot.send_message(uid, "Готов вынести это в «фокус недели» или идём дальше?", reply_markup=MAIN_MENU)
+        send(uid, "\n".join(summary), reply_markup=MAIN_MENU)
+        send(uid, "Готов вынести это в «фокус недели» или идём дальше?", reply_markup=MAIN_MENU)
         return
 
     save_state(uid, INTENT_FREE, STEP_FREE_CHAT, data)
-    bot.send_message(uid, "Окей, вернёмся на шаг назад и уточним ещё чуть-чуть.", reply_markup=MAIN_MENU)
+    send(uid, "Окей, вернёмся на шаг назад и уточним ещё чуть-чуть.", reply_markup=MAIN_MENU)
 
-# ========= Menu =========
-MENU_BTNS = {
-    "🚑 У меня ошибка": "error",
-    "🧩 Хочу стратегию": "strategy",
-    "📄 Паспорт": "passport",
-    "🗒 Панель недели": "weekpanel",
-    "🆘 Экстренно": "panic",
-    "🤔 Не знаю, с чего начать": "start_help",
+# ========= Callbacks =========
+def cb_confirm_problem(uid: int, st: Dict[str, Any]):
+    st["data"]["problem"] = st["data"].get("problem_draft", "—")
+    st["data"]["problem_confirmed"] = True
+    st["data"]["struct_offer_shown"] = False
+    save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
+    offer_structure(uid, st)
+
+def cb_refine_problem(uid: int, st: Dict[str, Any]):
+    st["data"]["problem_confirmed"] = False
+    save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
+    send(uid, "Хорошо. Сформулируй тогда поконкретнее, что именно разбирать.", reply_markup=MAIN_MENU)
+
+def cb_start_error_flow(uid: int, st: Dict[str, Any]):
+    st["data"]["problem_confirmed"] = True
+    save_state(uid, INTENT_ERR, STEP_ERR_DESCR, st["data"])
+    send(uid, "Начинаем разбор. Опиши последний случай: вход/план, где отступил, результат.")
+
+def cb_skip_error_flow(uid: int, st: Dict[str, Any]):
+    send(uid, "Окей, вернёмся к этому позже.", reply_markup=MAIN_MENU)
+
+def cb_continue_session(uid: int, st: Dict[str, Any]):
+    st["data"]["awaiting_reply"] = False
+    st["data"]["last_nag_at"] = _now_iso()
+    save_state(uid, data=st["data"])
+    send(uid, "Продолжаем. На чём остановились?", reply_markup=MAIN_MENU)
+
+def cb_restart_session(uid: int, st: Dict[str, Any]):
+    save_state(uid, INTENT_FREE, STEP_FREE_CHAT, {"history": [], "coach_turns": 0, "struct_offer_shown": False})
+    send(uid, "Окей, начнём заново. Что сейчас хочется поправить?", reply_markup=MAIN_MENU)
+
+CALLBACK_TABLE = {
+    "confirm_problem": cb_confirm_problem,
+    "refine_problem": cb_refine_problem,
+    "start_error_flow": cb_start_error_flow,
+    "skip_error_flow": cb_skip_error_flow,
+    "continue_session": cb_continue_session,
+    "restart_session": cb_restart_session,
 }
 
-@bot.message_handler(func=lambda m: m.text in MENU_BTNS)
-def handle_menu(m: types.Message):
-    uid = m.from_user.id
-    st = load_state(uid)
-    label = m.text
-    code = MENU_BTNS[label]
-    st["data"] = _append_history(st["data"], "user", label)
-
-    if code == "error":
-        if st["data"].get("problem_confirmed"):
-            save_state(uid, INTENT_ERR, STEP_ERR_DESCR, st["data"])
-            bot.send_message(uid, "Опиши последний кейс ошибки: где/когда, вход/стоп/план, где отступил, чем закончилось.")
-        else:
-            save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
-            bot.send_message(uid, "Коротко — что именно сейчас мешает? Сформулируй в одном-двух предложениях.", reply_markup=MAIN_MENU)
-    elif code == "start_help":
-        bot.send_message(uid, "План: 1) быстрый разбор проблемы, 2) фокус недели, 3) скелет ТС. С чего начнём?", reply_markup=MAIN_MENU)
-        save_state(uid, data=st["data"])
-    else:
-        bot.send_message(uid, "Ок. Если хочешь ускориться — нажми «🚑 У меня ошибка».", reply_markup=MAIN_MENU)
-        save_state(uid, data=st["data"])
-
-# ========= Callbacks =========
 @bot.callback_query_handler(func=lambda c: True)
 def on_cb(call: types.CallbackQuery):
     uid = call.from_user.id
-    data = call.data or ""
     bot.answer_callback_query(call.id, "Ок")
-    st = load_state(uid)
-
-    if data == "confirm_problem":
-        st["data"]["problem"] = st["data"].get("problem_draft", "—")
-        st["data"]["problem_confirmed"] = True
-        st["data"]["struct_offer_shown"] = False
-        save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
-        offer_structure(uid, st)
-        return
-
-    if data == "refine_problem":
-        st["data"]["problem_confirmed"] = False
-        save_state(uid, INTENT_FREE, STEP_FREE_CHAT, st["data"])
-        bot.send_message(uid, "Хорошо. Сформулируй тогда поконкретнее, что именно разбирать.", reply_markup=MAIN_MENU)
-        return
-
-    if data == "start_error_flow":
-        st["data"]["problem_confirmed"] = True
-        save_state(uid, INTENT_ERR, STEP_ERR_DESCR, st["data"])
-        bot.send_message(uid, "Начинаем разбор. Опиши последний случай: вход/план, где отступил, результат.")
-        return
-
-    if data == "skip_error_flow":
-        bot.send_message(uid, "Окей, вернёмся к этому позже.", reply_markup=MAIN_MENU)
-        return
-
-    if data == "continue_session":
-        st["data"]["awaiting_reply"] = False
-        st["data"]["last_nag_at"] = _now_iso()
-        save_state(uid, data=st["data"])
-        bot.send_message(uid, "Продолжаем. На чём остановились?", reply_markup=MAIN_MENU)
-        return
-
-    if data == "restart_session":
-        st = save_state(uid, INTENT_FREE, STEP_FREE_CHAT, {"history": [], "coach_turns": 0, "struct_offer_shown": False})
-        bot.send_message(uid, "Окей, начнём заново. Что сейчас хочется поправить?", reply_markup=MAIN_MENU)
-        return
+    handler = CALLBACK_TABLE.get(call.data or "")
+    if handler:
+        handler(uid, load_state(uid))
 
 # ========= HTTP =========
 @app.get("/")
 def root():
-    return jsonify({"ok": True, "time": _now_iso(), "version": BOT_VERSION, "openai": openai_status})
+    return jsonify({"ok": True, "time": now_iso_coarse(), "version": BOT_VERSION, "openai": openai_status})
 
 @app.get("/version")
 def version_api():
-    return jsonify({"version": BOT_VERSION, "code_hash": _code_hash(), "status": "running", "timestamp": _now_iso(), "openai": openai_status})
+    return jsonify({"version": BOT_VERSION, "code_hash": CODE_HASH, "status": "running", "timestamp": now_iso_coarse(), "openai": openai_status})
+
+# Ack-first: вебхук отвечает 200 сразу, апдейт обрабатывается в пуле воркеров,
+# чтобы OpenAI/БД не держали запрос Telegram. При UPDATE_WORKERS=0 — старый
+# синхронный путь с ответом в теле вебхука.
+update_pool: Optional[ThreadPoolExecutor] = (
+    ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update") if UPDATE_WORKERS > 0 else None
+)
+
+def _handle_update(update: types.Update, flush: bool) -> Optional[Dict[str, Any]]:
+    scope: Dict[str, Any] = {}
+    state_token = _state_cache.set({})
+    db_token = _db_scope.set(scope)
+    _outbox_open()
+    ok = False
+    try:
+        bot.process_new_updates([update])
+        ok = True
+    finally:
+        _db_scope.reset(db_token)
+        _state_cache.reset(state_token)
+        try:
+            _db_scope_close(scope, ok)  # коммитим до отправки: следующий апдейт увидит новое состояние
+        except Exception:
+            ok = False  # COMMIT не прошёл — это тоже откат
+            raise
+        finally:
+            if not ok:
+                # запись откатилась — ответы под новый шаг не шлём, иначе следующий
+                # ответ пользователя уйдёт по старому состоянию
+                _outbox_discard()
+                _send_update_error(update)
+    return _outbox_close(flush=flush)
+
+def _send_update_error(update: types.Update):
+    uid = _update_uid(update)
+    if uid is None:
+        return
+    try:
+        tg_send(uid, "Что-то пошло не так. Повтори, пожалуйста, последнее сообщение.")
+    except Exception as e:
+        logging.error("Error notice send failed: %s", e)
+
+def _process_update(update: types.Update):
+    global _pending_updates
+    try:
+        _handle_update(update, flush=True)
+    except Exception as e:
+        logging.error("Update processing error: %s", e)
+    finally:
+        with _user_queues_lock:
+            _pending_updates -= 1
+
+# Порядок внутри одного пользователя: апдейты одного uid идут строго друг за
+# другом (одна очередь — один воркер), разные пользователи — параллельно.
+_user_queues: Dict[int, deque] = {}
+_user_queues_lock = threading.Lock()
+_pending_updates = 0  # принято вебхуком и ещё не обработано — очередь пула не безразмерная
+
+def _update_uid(update: types.Update) -> Optional[int]:
+    if update.message and update.message.from_user:
+        return update.message.from_user.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return None
+
+def _drain_user(uid: int):
+    while True:
+        with _user_queues_lock:
+            q = _user_queues[uid]
+            if not q:
+                del _user_queues[uid]
+                return
+            update = q.popleft()
+        _process_update(update)
+
+def _enqueue_update(update: types.Update) -> bool:
+    # False — апдейт не принят, Telegram должен повторить (503)
+    global _pending_updates
+    uid = _update_uid(update)
+    with _user_queues_lock:
+        q = _user_queues.get(uid) if uid is not None else None
+        if q is not None and len(q) >= UPDATE_QUEUE_PER_USER:
+            # один чат не выедает общий бюджет: лишнее от него отбрасываем и подтверждаем,
+            # иначе ретраи Telegram только продлят его же очередь
+            logging.warning("User %s queue full (%s), dropping update %s", uid, UPDATE_QUEUE_PER_USER, update.update_id)
+            return True
+        if _pending_updates >= UPDATE_QUEUE_MAX:
+            return False
+        _pending_updates += 1
+        if q is not None:  # у пользователя уже работает воркер — встанем ему в очередь
+            q.append(update)
+            return True
+        if uid is not None:
+            _user_queues[uid] = deque([update])
+    try:
+        if uid is None:
+            update_pool.submit(_process_update, update)
+        else:
+            update_pool.submit(_drain_user, uid)
+    except Exception as e:
+        # пул закрыт (рестарт воркера gunicorn и т.п.): откатываем учёт, иначе
+        # очередь пользователя повиснет без воркера и съест все его апдейты
+        logging.error("Update submit error: %s", e)
+        with _user_queues_lock:
+            _pending_updates -= 1
+            if uid is not None:
+                _user_queues.pop(uid, None)
+        return False
+    return True
 
 @app.post(f"/{WEBHOOK_PATH}")
 def webhook():
@@ -579,70 +1302,90 @@ def webhook():
     if not body:
         abort(400, description="Empty body")
     try:
-        update = telebot.types.Update.de_json(body.decode("utf-8"))
-        if update is None:
-            abort(400, description="Invalid update")
-        bot.process_new_updates([update])
+        update = telebot.types.Update.de_json(orjson.loads(body))
+    except Exception as e:
+        logging.error("Webhook parse error: %s", e)
+        abort(400, description="Invalid update")
+    if update is None:
+        abort(400, description="Invalid update")
+    if update_pool:
+        if not _enqueue_update(update):
+            # перегруз или пул недоступен: не копим в памяти — Telegram переотправит апдейт сам
+            logging.warning("Rejecting update %s: queue full (%s) or pool unavailable", update.update_id, UPDATE_QUEUE_MAX)
+            abort(503)
         return "OK", 200
+    try:
+        reply = _handle_update(update, flush=False)
     except Exception as e:
+        # пользователю уже ушло «повтори» — не просим Telegram переотправлять апдейт
         logging.error("Webhook processing error: %s", e)
-        abort(500)
+        return "OK", 200
+    if reply:
+        return jsonify(reply), 200
+    return "OK", 200
 
 # ========= Housekeeping / Reminders =========
 def cleanup_old_states(days: int = 30):
     try:
         days = int(days)
-        db_exec(f"DELETE FROM user_state WHERE updated_at < NOW() - INTERVAL '{days} days'")
+        db_exec("DELETE FROM user_state WHERE updated_at < NOW() - make_interval(days => :days)", {"days": days})
         logging.info("Old user states cleanup done (> %s days).", days)
     except Exception as e:
         logging.error("Cleanup error: %s", e)
 
+# отметка «напомнили» — один UPDATE на всю пачку за тик, без RETURNING всей data
+_SQL_MARK_NAGGED = text("""
+    UPDATE user_state
+    SET data = COALESCE(data, '{}'::jsonb) || CAST(:patch AS JSONB), updated_at = now()
+    WHERE user_id = ANY(CAST(:uids AS BIGINT[]))
+""")
+
+def _mark_nagged(uids: List[int]):
+    if not uids:
+        return
+    ts = _now_iso()
+    patch = orjson.dumps({"last_nag_at": ts, "last_state_write_at": ts}).decode("utf-8")
+    db_exec(_SQL_MARK_NAGGED, {"uids": uids, "patch": patch})
+
 def reminder_tick():
     if not REMINDERS_ENABLED:
         return
     try:
         mins = IDLE_MINUTES_REMIND
         reset_mins = IDLE_MINUTES_RESET
-        rows = db_exec("SELECT user_id, intent, step, data, updated_at FROM user_state").mappings().all()
+        # только нужные ключи из jsonb, без истории; условие совпадает с idx_user_state_awaiting
+        rows = db_exec("""
+            SELECT user_id, data->>'last_user_msg_at' AS last_user_msg_at, data->>'last_nag_at' AS last_nag_at
+            FROM user_state WHERE (data->>'awaiting_reply') = 'true'
+        """).mappings().all()
         now = datetime.now(timezone.utc)
-        for r in rows:
-            try:
-                data = json.loads(r["data"] or "{}")
-            except Exception:
-                data = {}
-            if not data.get("awaiting_reply"):
-                continue
-            last_user_ts = data.get("last_user_msg_at")
-            if not last_user_ts:
-                continue
-            try:
-                last_dt = datetime.fromisoformat(last_user_ts)
-            except Exception:
-                continue
-            delta = now - last_dt
-            nag_ok = True
-            last_nag_at = data.get("last_nag_at")
-            if last_nag_at:
+        nagged: List[int] = []
+        try:
+            for r in rows:
+                last_user_ts = r["last_user_msg_at"]
+                if not last_user_ts:
+                    continue
                 try:
-                    if (now - datetime.fromisoformat(last_nag_at)) < timedelta(minutes=max(1, mins // 2)):
-                        nag_ok = False
+                    last_dt = datetime.fromisoformat(last_user_ts)
                 except Exception:
-                    pass
-            if delta >= timedelta(minutes=reset_mins) and nag_ok:
-                kb = types.InlineKeyboardMarkup().row(
-                    types.InlineKeyboardButton("Продолжаем", callback_data="continue_session"),
-                    types.InlineKeyboardButton("Начать заново", callback_data="restart_session"),
-                )
-                bot.send_message(r["user_id"], "Дела затащили? Готов продолжить или начнём заново?", reply_markup=kb)
-                data["last_nag_at"] = _now_iso()
-                save_state(r["user_id"], data=data)
-            elif delta >= timedelta(minutes=mins) and nag_ok:
-                kb = types.InlineKeyboardMarkup().row(
-                    types.InlineKeyboardButton("Продолжаем", callback_data="continue_session"),
-                )
-                bot.send_message(r["user_id"], "Как будешь готов — продолжим?", reply_markup=kb)
-                data["last_nag_at"] = _now_iso()
-                save_state(r["user_id"], data=data)
+                    continue
+                delta = now - last_dt
+                nag_ok = True
+                last_nag_at = r["last_nag_at"]
+                if last_nag_at:
+                    try:
+                        if (now - datetime.fromisoformat(last_nag_at)) < timedelta(minutes=max(1, mins // 2)):
+                            nag_ok = False
+                    except Exception:
+                        pass
+                if delta >= timedelta(minutes=reset_mins) and nag_ok:
+                    tg_send(r["user_id"], "Дела затащили? Готов продолжить или начнём заново?", reply_markup=RESUME_OR_RESET_KB)
+                    nagged.append(r["user_id"])
+                elif delta >= timedelta(minutes=mins) and nag_ok:
+                    tg_send(r["user_id"], "Как будешь готов — продолжим?", reply_markup=RESUME_KB)
+                    nagged.append(r["user_id"])
+        finally:
+            _mark_nagged(nagged)  # уже отправленные отмечаем, даже если тик оборвался
     except Exception as e:
         logging.error("Reminder error: %s", e)
 
@@ -656,19 +1399,20 @@ def background_housekeeping():
             last_cleanup = time.time()
 
 # ========= Init on import =========
-try:
-    init_db()
-    logging.info("DB initialized (import)")
-except Exception as e:
-    logging.error("DB init (import) failed: %s", e)
+if DB_AUTO_INIT:
+    try:
+        init_db()
+        logging.info("DB initialized (import)")
+    except Exception as e:
+        logging.error("DB init (import) failed: %s", e)
 
 if SET_WEBHOOK_FLAG:
     try:
-        bot.remove_webhook()
-        time.sleep(1)
+        # setWebhook сам заменяет прежний — remove_webhook + sleep только тормозили старт
         bot.set_webhook(
             url=f"{PUBLIC_URL}/{WEBHOOK_PATH}",
             secret_token=TG_SECRET,
+            max_connections=TG_MAX_CONNECTIONS,
             allowed_updates=["message", "callback_query"]
         )
         logging.info("Webhook set to %s/%s", PUBLIC_URL, WEBHOOK_PATH)
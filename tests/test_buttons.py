@@ -0,0 +1,25 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text_in", [
+    "🚑 У меня ошибка",
+    "у меня  ошибка ",
+    "У МЕНЯ ОШИБКА",
+    "🗒️ Панель недели",
+    "🤔 Не знаю, с чего начать",
+])
+def test_menu_labels_match(text_in):
+    assert main.button_key(text_in) in main.BUTTON_TABLE
+
+
+@pytest.mark.parametrize("text_in", [
+    "📉 Хочу стратегию",
+    "📉 Ошибка на входе",
+    "!!! Паспорт",
+    "🚑 У меня ошибка опять со стопом",
+    "Хочу стратегию на пробой",
+])
+def test_free_text_is_not_a_button(text_in):
+    assert main.button_key(text_in) not in main.BUTTON_TABLE
@@ -0,0 +1,14 @@
+import main
+
+
+def _key(text_in):
+    return main._cache_key("m", [{"role": "user", "content": text_in}], 0.3)
+
+
+def test_case_and_whitespace_share_a_key():
+    assert _key("Снял  стоп") == _key("снял стоп")
+
+
+def test_question_and_statement_differ():
+    assert _key("Снял стоп?") != _key("Снял стоп.")
+    assert _key("Снял стоп!") != _key("Снял стоп")
@@ -0,0 +1,54 @@
+import json
+
+import httpx
+import pytest
+from openai import OpenAI
+
+import main
+
+FULL = json.dumps({"response_text": "Что было со стопом?", "store": {}, "summary_draft": "",
+                   "readiness_score": 0.2, "ask_confirm": False}, ensure_ascii=False)
+TRUNCATED = FULL[:25]
+
+
+def _client(replies, calls):
+    def handler(req):
+        body = json.loads(req.content)
+        calls.append(body["max_tokens"])
+        content, finish = replies.pop(0)
+        return httpx.Response(200, json={
+            "id": "x", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": finish,
+                         "message": {"role": "assistant", "content": content}}],
+        })
+    return OpenAI(api_key="sk-test", max_retries=0, http_client=httpx.Client(transport=httpx.MockTransport(handler)))
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache(monkeypatch):
+    monkeypatch.setattr(main, "_gpt_cache", main.OrderedDict())
+
+
+def _msgs(text_in):
+    return [{"role": "user", "content": text_in}]
+
+
+def test_truncated_reply_is_retried_with_higher_cap(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "oai_client", _client([(TRUNCATED, "length"), (FULL, "stop")], calls))
+    js = main.gpt_json(_msgs("снял стоп"), 0.3)
+    assert js["response_text"] == "Что было со стопом?"
+    assert calls == [main.GPT_MAX_TOKENS, main.GPT_MAX_TOKENS * 2]
+    assert main.gpt_json(_msgs("снял стоп"), 0.3) == js  # закэшировано
+    assert len(calls) == 2
+
+
+def test_truncated_twice_falls_back_and_is_not_cached(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "oai_client", _client([(TRUNCATED, "length"), (TRUNCATED, "length")], calls))
+    monkeypatch.setattr(main, "OFFSCRIPT_ENABLED", True)
+    st = {"data": {"history": [{"role": "user", "content": "снял стоп опять"}]}}
+    decision = main.gpt_calibrate(1, "снял стоп опять", st)
+    assert decision["response_text"].startswith("Окей. Чтобы не спешить")  # fallback
+    assert len(calls) == 2
+    assert len(main._gpt_cache) == 0
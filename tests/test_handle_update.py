@@ -0,0 +1,68 @@
+import pytest
+from telebot import types
+
+import main
+
+
+def _update(uid=5):
+    return types.Update.de_json({
+        "update_id": 1,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+                    "from": {"id": uid, "is_bot": False, "first_name": "A"}, "text": "hi"},
+    })
+
+
+class _Tx:
+    def __init__(self, fail):
+        self.fail = fail
+        self.done = None
+
+    def commit(self):
+        if self.fail:
+            raise RuntimeError("could not serialize access")
+        self.done = "commit"
+
+    def rollback(self):
+        self.done = "rollback"
+
+
+class _Conn:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_commit_failure_discards_outbox_and_notifies(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "tg_send", lambda chat_id, text_out, **kw: sent.append(text_out))
+
+    def handler(updates):
+        scope = main._db_scope.get()
+        scope["conn"], scope["tx"] = _Conn(), _Tx(fail=True)
+        main.send(5, "Следующий шаг?")
+
+    monkeypatch.setattr(main.bot, "process_new_updates", handler)
+    with pytest.raises(RuntimeError):
+        main._handle_update(_update(), flush=False)
+    assert sent == ["Что-то пошло не так. Повтори, пожалуйста, последнее сообщение."]
+    assert getattr(main._outbox, "pending", None) is None
+
+
+def test_release_is_skipped_after_a_write():
+    tx = _Tx(fail=False)
+    scope = {"conn": _Conn(), "tx": tx}
+    token = main._db_scope.set(scope)
+    try:
+        main.db_mark_write()
+        main.db_release()
+        assert "conn" in scope and tx.done is None
+    finally:
+        main._db_scope.reset(token)
+    scope.pop("wrote")
+    token = main._db_scope.set(scope)
+    try:
+        main.db_release()
+        assert "conn" not in scope and tx.done == "commit"
+    finally:
+        main._db_scope.reset(token)
@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text_in", ["3", "50%", "-2000$", "2:1", "ок", "окей", "ok", "ага", "угу"])
+def test_answers_are_not_smalltalk(text_in):
+    assert not main.is_smalltalk(text_in)
+
+
+@pytest.mark.parametrize("text_in", ["Привет!", "спасибо", "👍", "...", ""])
+def test_greetings_and_symbols_are_smalltalk(text_in):
+    assert main.is_smalltalk(text_in)
+
+
+def test_pending_question_detected():
+    history = [
+        {"role": "user", "content": "снял стоп"},
+        {"role": "assistant", "content": "Сколько раз за неделю?"},
+        {"role": "user", "content": "👍"},
+    ]
+    assert main.answers_question(history, "👍")
+    assert not main.answers_question(history[:1], "👍")
+
+
+def test_smalltalk_shortcut_skipped_when_answering(monkeypatch):
+    calls = []
+
+    def fake_gpt_json(msgs, temperature, chat_id=None):
+        calls.append(msgs)
+        return {"response_text": "Понял, что дальше?", "store": {}, "summary_draft": "",
+                "readiness_score": 0.1, "ask_confirm": False}
+
+    monkeypatch.setattr(main, "oai_client", object())
+    monkeypatch.setattr(main, "OFFSCRIPT_ENABLED", True)
+    monkeypatch.setattr(main, "gpt_json", fake_gpt_json)
+    st = {"data": {"history": [
+        {"role": "assistant", "content": "Это было больше одного раза?"},
+        {"role": "user", "content": "👍"},
+    ]}}
+    assert main.gpt_calibrate(1, "👍", st)["response_text"] == "Понял, что дальше?"
+    assert len(calls) == 1
+
+    st = {"data": {"history": [{"role": "user", "content": "привет"}]}}
+    main.gpt_calibrate(1, "привет", st)
+    assert len(calls) == 1
@@ -0,0 +1,24 @@
+import main
+
+
+def test_literal_angle_brackets_are_not_tags():
+    text_in = "a < b " * 1500
+    parts = main.split_message(text_in)
+    assert all(len(p) <= main.TG_TEXT_LIMIT for p in parts)
+    assert all(len(p) > 3000 for p in parts[:-1])
+    assert len(parts) == 3
+
+
+def test_cut_never_splits_an_entity():
+    parts = main.split_message("&amp;" * 2000)
+    assert all(len(p) <= main.TG_TEXT_LIMIT for p in parts)
+    for p in parts:
+        assert p.startswith("&amp;") and p.endswith("&amp;")
+    assert "".join(parts) == "&amp;" * 2000
+
+
+def test_tags_stay_balanced():
+    parts = main.split_message("<b>" + "слово " * 1500 + "</b>")
+    assert len(parts) > 1
+    for p in parts:
+        assert p.startswith("<b>") and p.endswith("</b>")
@@ -0,0 +1,63 @@
+from telebot import types
+
+import main
+
+
+def _payload(uid, update_id=1):
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": uid, "type": "private"},
+                    "from": {"id": uid, "is_bot": False, "first_name": "A"}, "text": "hi"},
+    }
+
+
+class _ClosedPool:
+    def submit(self, *args, **kwargs):
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+
+def test_failed_submit_rolls_back(monkeypatch):
+    monkeypatch.setattr(main, "update_pool", _ClosedPool())
+    monkeypatch.setattr(main, "_pending_updates", 0)
+    monkeypatch.setattr(main, "_user_queues", {})
+    assert main._enqueue_update(types.Update.de_json(_payload(7))) is False
+    assert main._pending_updates == 0
+    assert 7 not in main._user_queues
+
+
+def test_webhook_answers_503_when_pool_is_down(monkeypatch):
+    monkeypatch.setattr(main, "update_pool", _ClosedPool())
+    monkeypatch.setattr(main, "_pending_updates", 0)
+    monkeypatch.setattr(main, "_user_queues", {})
+    resp = main.app.test_client().post(
+        f"/{main.WEBHOOK_PATH}",
+        data=main.orjson.dumps(_payload(8, 5)),
+        headers={"X-Telegram-Bot-Api-Secret-Token": main.TG_SECRET, "Content-Type": "application/json"},
+    )
+    assert resp.status_code == 503
+    assert main._pending_updates == 0
+
+
+class _IdlePool:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+
+
+def test_per_user_cap_drops_only_that_user(monkeypatch):
+    pool = _IdlePool()
+    monkeypatch.setattr(main, "update_pool", pool)
+    monkeypatch.setattr(main, "UPDATE_QUEUE_PER_USER", 2)
+    monkeypatch.setattr(main, "_pending_updates", 0)
+    monkeypatch.setattr(main, "_user_queues", {})
+    for i in range(3):
+        assert main._enqueue_update(types.Update.de_json(_payload(9, i))) is True
+    assert len(main._user_queues[9]) == 2
+    assert main._pending_updates == 2
+    # лишнее отброшено и подтверждено, чужой чат всё ещё принимается
+    assert main._enqueue_update(types.Update.de_json(_payload(10, 100))) is True
+    assert len(main._user_queues[10]) == 1
+    assert main._pending_updates == 3
+    assert pool.submitted == [(9,), (10,)]